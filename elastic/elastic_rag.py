@@ -1,6 +1,10 @@
 import os
 import sys
+from bisect import bisect_left
+from datetime import datetime, timezone
+from functools import lru_cache
 from elasticsearch import Elasticsearch
+from elasticsearch.helpers import parallel_bulk
 from dotenv import load_dotenv
 
 # Add parent directory to path for imports
@@ -12,6 +16,14 @@ load_dotenv()
 ES_HOST = os.getenv("ELASTICSEARCH_HOST", "http://localhost:9200")
 ES_CLOUD_ID = os.getenv("ELASTICSEARCH_CLOUD_ID", None)
 ES_API_KEY = os.getenv("ELASTICSEARCH_API_KEY", None)
+# HTTP connections kept open per node (concurrent ingest/search)
+ES_POOL_SIZE = int(os.getenv("ES_POOL_SIZE", "32"))
+
+# Bulk indexing batch limits (docs per request / bytes per request)
+ES_BULK_CHUNK_SIZE = int(os.getenv("ES_BULK_CHUNK_SIZE", "1000"))
+ES_BULK_MAX_BYTES = int(os.getenv("ES_BULK_MAX_BYTES", str(10 * 1024 * 1024)))
+# Parallel bulk workers (never more than the connection pool can serve)
+ES_BULK_THREADS = min(int(os.getenv("ES_BULK_THREADS", "4")), ES_POOL_SIZE)
 
 # Index names - separate for each OCR model
 ES_INDEX_MINERU = os.getenv("ELASTICSEARCH_INDEX", "pdf_documents")
@@ -20,26 +32,44 @@ ES_INDEX_PADDLE = os.getenv("ELASTICSEARCH_INDEX_PADDLE", "pdf_documents_paddle"
 # Default index (for backward compatibility)
 ES_INDEX = ES_INDEX_MINERU
 
-# Initialize Elasticsearch client
+# Tokenizer of the embedding model, used to size chunks in tokens
+EMBEDDING_TOKENIZER = os.getenv("EMBEDDING_TOKENIZER", "intfloat/e5-large-v2")
+_tokenizer = None
+
+# Chunking strategy: "recursive" (structure-aware) or "window" (fixed K/S sliding window)
+CHUNK_STRATEGY = os.getenv("CHUNK_STRATEGY", "recursive")
+
+# Initialize Elasticsearch client (one per process, reused across calls)
+@lru_cache(maxsize=1)
 def get_es_client():
     if ES_CLOUD_ID:
         # Elastic Cloud with Cloud ID
-        return Elasticsearch(cloud_id=ES_CLOUD_ID, api_key=ES_API_KEY)
+        return Elasticsearch(cloud_id=ES_CLOUD_ID, api_key=ES_API_KEY, connections_per_node=ES_POOL_SIZE)
     elif ES_API_KEY:
         # Self-hosted or Elastic Cloud with URL + API Key
-        return Elasticsearch(ES_HOST, api_key=ES_API_KEY)
+        return Elasticsearch(ES_HOST, api_key=ES_API_KEY, connections_per_node=ES_POOL_SIZE)
     else:
         # Local without auth
-        return Elasticsearch(ES_HOST)
+        return Elasticsearch(ES_HOST, connections_per_node=ES_POOL_SIZE)
 
 
 # -----------------------------
 # Step 1: Create index with mappings
 # -----------------------------
 def create_index(es, index_name=ES_INDEX):
-    """Create index with proper mappings for RAG"""
+    """Create index with proper mappings for RAG. Returns True if it was created."""
     
     mappings = {
+        "settings": {
+            "index": {
+                # Born ready for the initial bulk load; serving settings
+                # (replicas, refresh) are applied once ingest finishes
+                "number_of_replicas": 0,
+                "refresh_interval": "-1",
+                # Fewer translog flushes during bulk loads
+                "translog.flush_threshold_size": "1gb"
+            }
+        },
         "mappings": {
             "properties": {
                 "content": {
@@ -65,55 +95,200 @@ def create_index(es, index_name=ES_INDEX):
     if not es.indices.exists(index=index_name):
         es.indices.create(index=index_name, body=mappings)
         print(f"✅ Index '{index_name}' created")
-    else:
-        print(f"ℹ️ Index '{index_name}' already exists")
+        return True
+    print(f"ℹ️ Index '{index_name}' already exists")
+    return False
 
 
 # -----------------------------
 # Step 2: Chunk markdown content
 # -----------------------------
-def chunk_markdown(markdown_content, chunk_size=1000, overlap=200):
-    """Split markdown into overlapping chunks for better retrieval"""
-    chunks = []
+def get_tokenizer():
+    """Load the embedding tokenizer once per process (needs `transformers`)"""
+    global _tokenizer
+    if _tokenizer is None:
+        try:
+            from transformers import AutoTokenizer
+        except ImportError as e:
+            raise ImportError("Token-aware chunking needs `transformers`: pip install transformers") from e
+        _tokenizer = AutoTokenizer.from_pretrained(EMBEDDING_TOKENIZER, use_fast=True)
+        if not _tokenizer.is_fast:
+            raise ValueError(f"'{EMBEDDING_TOKENIZER}' has no fast tokenizer; chunking needs its offset mapping")
+    return _tokenizer
+
+
+def token_starts(text):
+    """
+    Character offset where each token of text starts, from a single encode.
+    Chunks are sliced from the original text at these offsets, never decoded
+    (decoding an uncased tokenizer lowercases and strips accents/jamo).
+    """
+    encoding = get_tokenizer()(text, add_special_tokens=False, return_offsets_mapping=True)
+    return [start for start, _ in encoding["offset_mapping"]]
+
+
+def _span_tokens(starts, begin, end):
+    """Number of tokens starting inside text[begin:end]"""
+    return bisect_left(starts, end) - bisect_left(starts, begin)
+
+
+def _recursive_split(text, starts, begin, end, max_tokens, seps=("\n\n", "\n", ". ", " ")):
+    """
+    Split text[begin:end] on the coarsest separator first (paragraph → line → sentence → word),
+    recursing with the next separator on any piece still over max_tokens.
+    Returns (begin, end) character spans; separators stay at the end of their piece.
+    """
+    if _span_tokens(starts, begin, end) <= max_tokens:
+        return [(begin, end)] if _span_tokens(starts, begin, end) else []
     
-    # Split by double newlines (paragraphs) first
-    paragraphs = markdown_content.split("\n\n")
+    if not seps:
+        # Nothing left to split on: hard cut at token boundaries
+        first, last = bisect_left(starts, begin), bisect_left(starts, end)
+        cuts = [begin] + starts[first + max_tokens:last:max_tokens] + [end]
+        return list(zip(cuts, cuts[1:]))
     
-    current_chunk = ""
-    chunk_id = 0
+    sep, rest = seps[0], seps[1:]
+    pieces = []
+    buffer_start = None
+    buffer_tokens = 0
     
-    for para in paragraphs:
-        if len(current_chunk) + len(para) < chunk_size:
-            current_chunk += para + "\n\n"
+    pos = begin
+    while pos < end:
+        hit = text.find(sep, pos, end)
+        part_end = end if hit == -1 else hit + len(sep)
+        part_tokens = _span_tokens(starts, pos, part_end)
+        
+        if part_tokens > max_tokens:
+            if buffer_start is not None:
+                pieces.append((buffer_start, pos))
+                buffer_start, buffer_tokens = None, 0
+            pieces.extend(_recursive_split(text, starts, pos, part_end, max_tokens, rest))
         else:
-            if current_chunk.strip():
-                chunks.append({
-                    "chunk_id": chunk_id,
-                    "content": current_chunk.strip()
-                })
-                chunk_id += 1
-            
-            # Start new chunk with overlap
-            overlap_text = current_chunk[-overlap:] if len(current_chunk) > overlap else current_chunk
-            current_chunk = overlap_text + para + "\n\n"
-    
-    # Don't forget the last chunk
-    if current_chunk.strip():
-        chunks.append({
+            # Pack neighbouring parts together while they fit the budget
+            if buffer_start is not None and buffer_tokens + part_tokens > max_tokens:
+                pieces.append((buffer_start, pos))
+                buffer_start, buffer_tokens = None, 0
+            if buffer_start is None:
+                buffer_start = pos
+            buffer_tokens += part_tokens
+        pos = part_end
+    
+    if buffer_start is not None:
+        pieces.append((buffer_start, end))
+    
+    return [p for p in pieces if _span_tokens(starts, *p)]
+
+
+def sliding_window_chunks(markdown_content, window=256, stride=192):
+    """
+    Yield fixed windows of `window` tokens every `stride` tokens,
+    so consecutive chunks always overlap by exactly window - stride tokens
+    """
+    if not 0 < stride <= window:
+        raise ValueError(f"stride must be in (0, window], got window={window}, stride={stride}")
+    
+    encoding = get_tokenizer()(markdown_content, add_special_tokens=False, return_offsets_mapping=True)
+    offsets = encoding["offset_mapping"]
+    
+    if not offsets:
+        return
+    
+    # Last start is pulled far enough right that the final window reaches the end
+    for chunk_id, start in enumerate(range(0, max(len(offsets) - window, 0) + stride, stride)):
+        last = min(start + window, len(offsets)) - 1
+        yield {
             "chunk_id": chunk_id,
-            "content": current_chunk.strip()
-        })
+            "content": markdown_content[offsets[start][0]:offsets[last][1]]
+        }
+
+
+def _merge_small_pieces(pieces, starts, min_tokens, max_tokens):
+    """
+    Merge spans under min_tokens into the next one (a small trailing span joins
+    the last), but only while the merged span stays within max_tokens
+    """
+    pending = carry = None
+    for span in pieces:
+        if carry is not None:
+            if _span_tokens(starts, carry[0], span[1]) <= max_tokens:
+                span = (carry[0], span[1])
+            else:
+                if pending is not None:
+                    yield pending
+                pending = carry
+            carry = None
+        if _span_tokens(starts, *span) < min_tokens:
+            carry = span
+            continue
+        if pending is not None:
+            yield pending
+        pending = span
     
-    return chunks
+    if carry is not None:
+        if pending is not None and _span_tokens(starts, pending[0], carry[1]) <= max_tokens:
+            pending = (pending[0], carry[1])
+        else:
+            if pending is not None:
+                yield pending
+            pending = carry
+    if pending is not None:
+        yield pending
+
+
+def chunk_markdown(markdown_content, max_tokens=200, overlap=20, min_tokens=100, strategy=CHUNK_STRATEGY,
+                   window=256, stride=192):
+    """
+    Lazily split markdown into overlapping, token-sized chunks for better retrieval
+    
+    Args:
+        markdown_content: The markdown text to chunk
+        max_tokens: Token budget per chunk (before overlap)
+        overlap: Tokens carried over from the end of the previous chunk
+        min_tokens: Chunks smaller than this are merged into the next one
+        strategy: "recursive" or "window" (see sliding_window_chunks)
+        window: Tokens per chunk for the "window" strategy
+        stride: Tokens between window starts for the "window" strategy
+    
+    max_tokens, overlap and min_tokens apply to "recursive" only.
+    
+    Yields:
+        {"chunk_id": int, "content": str} dicts, one per chunk
+    """
+    if strategy == "window":
+        yield from sliding_window_chunks(markdown_content, window, stride)
+        return
+    
+    # Tokenize once; everything below works on character spans of the original text
+    starts = token_starts(markdown_content)
+    pieces = _recursive_split(markdown_content, starts, 0, len(markdown_content), max_tokens)
+    
+    previous_begin = 0
+    for chunk_id, (begin, end) in enumerate(_merge_small_pieces(pieces, starts, min_tokens, max_tokens)):
+        content_begin = begin
+        if overlap and chunk_id:
+            # Start next chunk with overlap: back up `overlap` tokens into the previous one
+            first = bisect_left(starts, begin)
+            content_begin = max(starts[max(first - overlap, 0)], previous_begin)
+        yield {
+            "chunk_id": chunk_id,
+            "content": markdown_content[content_begin:end].strip()
+        }
+        previous_begin = begin
 
 
 # -----------------------------
 # Step 3: Index chunks to Elasticsearch
 # -----------------------------
-def index_chunks(es, chunks, source_file, index_name=ES_INDEX):
-    """Index all chunks to Elasticsearch using bulk API"""
-    from datetime import datetime, timezone
-    from elasticsearch.helpers import bulk
+def index_chunks(es, chunks, source_file, index_name=ES_INDEX,
+                 chunk_size=ES_BULK_CHUNK_SIZE, max_chunk_bytes=ES_BULK_MAX_BYTES,
+                 thread_count=ES_BULK_THREADS, request_timeout=120):
+    """
+    Index chunks (any iterable, consumed lazily) to Elasticsearch using the
+    bulk API on parallel workers. Returns the number of indexed chunks.
+    """
+    # All chunks of one ingest share the same timestamp and id prefix
+    created_at = datetime.now(timezone.utc).isoformat()
+    id_prefix = f"{source_file}_"
     
     def generate_actions():
         for chunk in chunks:
@@ -121,37 +296,59 @@ def index_chunks(es, chunks, source_file, index_name=ES_INDEX):
                 "_index": index_name,
                 "_source": {
                     "content": chunk["content"],
-                    "chunk_id": f"{source_file}_{chunk['chunk_id']}",
+                    "chunk_id": id_prefix + str(chunk["chunk_id"]),
                     "source_file": source_file,
-                    "created_at": datetime.now(timezone.utc).isoformat()
+                    "created_at": created_at
                 }
             }
     
-    success, failed = bulk(es, generate_actions(), raise_on_error=False)
-    es.indices.refresh(index=index_name)
+    success = failed = 0
+    for ok, _ in parallel_bulk(
+        es.options(request_timeout=request_timeout),
+        generate_actions(),
+        thread_count=thread_count,
+        chunk_size=chunk_size,
+        max_chunk_bytes=max_chunk_bytes,
+        raise_on_error=False
+    ):
+        if ok:
+            success += 1
+        else:
+            failed += 1
     print(f"✅ Indexed {success} chunks from '{source_file}' ({failed} failed)")
+    return success
 
 
 # -----------------------------
 # Step 4: Search / RAG query
 # -----------------------------
-def search_documents(es, query, top_k=5, index_name=ES_INDEX):
-    """Search for relevant chunks using the query"""
+def search_documents(es, query, top_k=5, index_name=ES_INDEX, fuzzy=False):
+    """
+    Search for relevant chunks using the query
+    
+    Plain match by default (75% of query terms must match); fuzzy=True opts
+    into typo tolerance at the cost of expanding every term at query time.
+    Searches go through the shard request cache, so repeated questions are cheap.
+    """
+    
+    match = {
+        "query": query,
+        "minimum_should_match": "75%"
+    }
+    if fuzzy:
+        match["fuzziness"] = "AUTO"
     
     search_body = {
         "query": {
             "match": {
-                "content": {
-                    "query": query,
-                    "fuzziness": "AUTO"
-                }
+                "content": match
             }
         },
         "size": top_k,
         "_source": ["content", "chunk_id", "source_file"]
     }
     
-    response = es.search(index=index_name, body=search_body)
+    response = es.search(index=index_name, body=search_body, request_cache=True)
     
     results = []
     for hit in response["hits"]["hits"]:
@@ -168,6 +365,11 @@ def search_documents(es, query, top_k=5, index_name=ES_INDEX):
 # -----------------------------
 # Main pipeline function
 # -----------------------------
+def _apply_serving_settings(es, index_name, settings):
+    es.indices.put_settings(index=index_name, body={"index": settings})
+    es.indices.refresh(index=index_name)
+
+
 def ingest_markdown_to_elastic(markdown_content, source_file, index_name=ES_INDEX):
     """
     Full pipeline: chunk markdown and index to Elasticsearch
@@ -179,17 +381,36 @@ def ingest_markdown_to_elastic(markdown_content, source_file, index_name=ES_INDE
     """
     es = get_es_client()
     
-    # Create index if needed
-    create_index(es, index_name)
+    # Load the chunking tokenizer first, so a missing dependency fails
+    # before any index settings are touched
+    get_tokenizer()
     
-    # Chunk the content
-    chunks = chunk_markdown(markdown_content)
-    print(f"📄 Created {len(chunks)} chunks")
+    if create_index(es, index_name):
+        # New index is born without replicas or refresh; after the first load
+        # it switches to serving settings (replicas built from the full primary)
+        serving_settings = {"number_of_replicas": 1, "refresh_interval": "5s"}
+    else:
+        # Existing index: pause refresh during ingest, then put back whatever
+        # the operator had (None resets an unset value to the default)
+        current = es.indices.get_settings(index=index_name, name="index.refresh_interval")
+        index_settings = next(iter(current.values()), {}).get("settings", {}).get("index", {})
+        serving_settings = {"refresh_interval": index_settings.get("refresh_interval")}
+        es.indices.put_settings(index=index_name, body={"index": {"refresh_interval": "-1"}})
     
-    # Index chunks
-    index_chunks(es, chunks, source_file, index_name)
+    # Chunks are streamed straight into bulk indexing, with refresh
+    # disabled so segments aren't cut mid-ingest
+    try:
+        num_chunks = index_chunks(es, chunk_markdown(markdown_content), source_file, index_name)
+    except BaseException:
+        # Still restore the index, but never let that hide the ingest error
+        try:
+            _apply_serving_settings(es, index_name, serving_settings)
+        except Exception as e:
+            print(f"⚠️ Failed to restore settings on '{index_name}': {e}")
+        raise
+    _apply_serving_settings(es, index_name, serving_settings)
     
-    return len(chunks)
+    return num_chunks
 
 
 def ask_question(question, top_k=3, index_name=ES_INDEX):
@@ -1,10 +1,14 @@
 import requests
 import os
 import time
+import random
 import zipfile
-import io
+import tempfile
 import json
+import re
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 load_dotenv()
 
@@ -17,9 +21,40 @@ HEADERS = {
     "Content-Type": "application/json"
 }
 
+# Shared session: keep-alive connections are reused across polls/downloads.
+# Auth headers stay per-call, since presigned upload/download URLs must not get them.
+# Only GETs are retried; POST/PUT bodies are not safely replayable.
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=8,
+    pool_maxsize=32,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[502, 503, 504],
+                      allowed_methods=frozenset({"GET"}))
+))
+
 OUTPUT_DIR = os.path.join(os.path.dirname(__file__), "..", "output")
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
+# Largest single markdown file read from an extracted result
+MAX_MARKDOWN_BYTES = int(os.getenv("MINERU_MAX_MD_BYTES", str(200 * 1024 * 1024)))
+
+# Known VLM garbage patterns, matched in a single regex pass per line
+GARBAGE_PATTERNS = [
+    r'흫사무수단lage',
+    r'희사무수단lage',
+    r'사원법law',
+    r'(majority의\s*){5,}',
+    r'(minority의\s*){5,}',
+]
+_GARBAGE_RE = re.compile("|".join(GARBAGE_PATTERNS))
+# Same word repeated more than 10 times in a row (hallucinated loops)
+_REPEAT_RE = re.compile(r"\b(\w+)(?:\s+\1){10,}\b")
+
+_TABLE_RE = re.compile(r'<table>.*?</table>', re.DOTALL)
+# Stray <td>/<tr> tags (→ space) and <table> tags (→ removed) in one pass
+_STRAY_TAG_RE = re.compile(r'</?(?:t[dr]|(table)).*?>')
+_BLANK_RE = re.compile(r'\n{4,}')
+
 
 # -----------------------------
 # Step 1: Request upload URL
@@ -48,7 +83,7 @@ def request_upload_url(file_name, data_id="doc_001", model_version="vlm"):
         "enable_table": True,      # Better table extraction
     }
 
-    res = requests.post(url, headers=HEADERS, json=payload)
+    res = _SESSION.post(url, headers=HEADERS, json=payload)
     res.raise_for_status()
     data = res.json()
 
@@ -65,8 +100,9 @@ def request_upload_url(file_name, data_id="doc_001", model_version="vlm"):
 # Step 2: Upload file
 # -----------------------------
 def upload_file(upload_url, file_path):
+    # requests streams a file-object body from disk and sets Content-Length itself
     with open(file_path, "rb") as f:
-        res = requests.put(upload_url, data=f)
+        res = _SESSION.put(upload_url, data=f)
 
     if res.status_code != 200:
         raise Exception(f"Upload failed: {res.status_code}")
@@ -77,11 +113,16 @@ def upload_file(upload_url, file_path):
 # -----------------------------
 # Step 3: Poll batch task
 # -----------------------------
-def poll_batch(batch_id, interval=10):
+def poll_batch(batch_id, interval=2, max_interval=30):
+    """
+    Poll until the batch is done, backing off exponentially (with jitter)
+    from `interval` up to `max_interval` seconds between polls
+    """
     url = f"{BASE_URL}/extract-results/batch/{batch_id}"
+    delay = interval
 
     while True:
-        res = requests.get(url, headers=HEADERS)
+        res = _SESSION.get(url, headers=HEADERS)
         res.raise_for_status()
         data = res.json()
 
@@ -100,7 +141,8 @@ def poll_batch(batch_id, interval=10):
         if state == "failed":
             raise Exception(f"OCR failed: {results[0].get('err_msg')}")
 
-        time.sleep(interval)
+        time.sleep(delay + random.uniform(0, 0.25 * delay))
+        delay = min(delay * 1.5, max_interval)
 
 
 # -----------------------------
@@ -110,13 +152,21 @@ def download_and_extract(zip_url, extract_to=OUTPUT_DIR):
     """Download ZIP and extract markdown/json files"""
     print(f"📥 Downloading result from: {zip_url}")
     
-    res = requests.get(zip_url, timeout=300)
-    res.raise_for_status()
-    
-    # Extract ZIP in memory
-    with zipfile.ZipFile(io.BytesIO(res.content)) as z:
-        z.extractall(extract_to)
-        extracted_files = z.namelist()
+    # Stream ZIP to a temp file instead of holding it in memory
+    with _SESSION.get(zip_url, stream=True, timeout=300) as res:
+        res.raise_for_status()
+        tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".zip")
+        # Removed on any outcome, including a partial download
+        try:
+            with tmp:
+                for block in res.iter_content(chunk_size=1 << 20):
+                    tmp.write(block)
+            
+            with zipfile.ZipFile(tmp.name) as z:
+                z.extractall(extract_to)
+                extracted_files = z.namelist()
+        finally:
+            os.unlink(tmp.name)
     
     print(f"✅ Extracted {len(extracted_files)} files to: {extract_to}")
     return extracted_files
@@ -132,55 +182,23 @@ def clean_markdown(text):
     - Clean up broken table HTML
     - Remove gibberish patterns
     """
-    import re
-    
-    # Remove lines with excessive repetition (same word 5+ times)
-    lines = text.split('\n')
-    cleaned_lines = []
-    
-    for line in lines:
-        # Detect repetitive patterns (word repeated 5+ times)
-        words = line.split()
-        if len(words) > 5:
-            word_counts = {}
-            for w in words:
-                word_counts[w] = word_counts.get(w, 0) + 1
-            max_repeat = max(word_counts.values()) if word_counts else 0
-            # Skip lines where any word repeats more than 10 times
-            if max_repeat > 10:
-                continue
-        
-        # Skip known garbage patterns
-        garbage_patterns = [
-            r'흫사무수단lage',
-            r'희사무수단lage', 
-            r'사원법law',
-            r'(majority의\s*){5,}',
-            r'(minority의\s*){5,}',
-        ]
-        skip = False
-        for pattern in garbage_patterns:
-            if re.search(pattern, line):
-                skip = True
-                break
-        if skip:
-            continue
-        
-        cleaned_lines.append(line)
+    # Drop lines with hallucinated repetition or known garbage
+    cleaned_lines = [
+        line for line in text.split('\n')
+        if not (_REPEAT_RE.search(line) or _GARBAGE_RE.search(line))
+    ]
     
     text = '\n'.join(cleaned_lines)
     
     # Convert HTML tables to simple format (basic cleanup)
     # Remove problematic colspan/rowspan tables
-    text = re.sub(r'<table>.*?</table>', '[TABLE REMOVED - See original PDF]', text, flags=re.DOTALL)
+    text = _TABLE_RE.sub('[TABLE REMOVED - See original PDF]', text)
     
     # Clean up stray HTML tags
-    text = re.sub(r'</?t[dr].*?>', ' ', text)
-    text = re.sub(r'</?table.*?>', '', text)
-    text = re.sub(r'</?tr.*?>', '', text)
+    text = _STRAY_TAG_RE.sub(lambda m: '' if m.group(1) else ' ', text)
     
     # Remove empty lines clusters (more than 3 empty lines)
-    text = re.sub(r'\n{4,}', '\n\n\n', text)
+    text = _BLANK_RE.sub('\n\n\n', text)
     
     return text
 
@@ -188,23 +206,30 @@ def clean_markdown(text):
 # -----------------------------
 # Step 6: Get markdown content
 # -----------------------------
-def get_markdown_content(output_dir=OUTPUT_DIR, clean=True):
+def get_markdown_content(output_dir=OUTPUT_DIR, clean=True, max_file_bytes=MAX_MARKDOWN_BYTES):
     """Find and return markdown content from extracted files"""
-    markdown_content = ""
+    md_parts = []
     json_data = None
     
     for root, dirs, files in os.walk(output_dir):
         for f in files:
             filepath = os.path.join(root, f)
             if f.endswith(".md"):
+                # Guard against malformed OCR output blowing up memory
+                size = os.path.getsize(filepath)
+                if size > max_file_bytes:
+                    print(f"⚠️ Skipping markdown {f}: {size} bytes exceeds {max_file_bytes}")
+                    continue
                 with open(filepath, "r", encoding="utf-8") as file:
-                    markdown_content += file.read() + "\n\n"
+                    md_parts.append(file.read())
                 print(f"📄 Found markdown: {f}")
-            elif f.endswith(".json"):
+            elif f.endswith(".json") and json_data is None:
                 with open(filepath, "r", encoding="utf-8") as file:
                     json_data = json.load(file)
                 print(f"📋 Found JSON: {f}")
     
+    markdown_content = "\n\n".join(md_parts)
+    
     if clean:
         print("🧹 Cleaning OCR artifacts...")
         markdown_content = clean_markdown(markdown_content)
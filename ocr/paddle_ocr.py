@@ -7,9 +7,32 @@ import requests
 import os
 import re
 import base64
+import html
+import mmap
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timezone
 from dotenv import load_dotenv
-from html.parser import HTMLParser
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# lxml tokenizes table HTML in C; without it tables are parsed with regexes
+try:
+    from lxml import html as lxml_html
+except ImportError:
+    lxml_html = None
+
+# orjson is much faster on the multi-MB base64 request body; fall back to stdlib json
+try:
+    import orjson
+    _json_dumps = orjson.dumps
+    _json_loads = orjson.loads
+except ImportError:
+    import json
+    
+    def _json_dumps(obj):
+        return json.dumps(obj).encode("utf-8")
+    
+    _json_loads = json.loads
 
 load_dotenv()
 
@@ -18,45 +41,112 @@ PADDLE_ACCESS_TOKEN = os.getenv("ACCESS_TOKEN")  # From AI Studio
 # PP-StructureV3 layout-parsing endpoint (from your AI Studio app)
 URL_API_PADDLE = os.getenv("API_URL_PADDLE")
 
-OUTPUT_DIR = os.path.join(os.path.dirname(__file__), "..", "output_paddle")
+HEADERS = {
+    "Authorization": f"token {PADDLE_ACCESS_TOKEN}",
+    "Content-Type": "application/json",
+}
+
+# Request options shared by every parse call; per-call keys are added on top
+PAYLOAD_DEFAULTS = {
+    "useDocOrientationClassify": False,
+    "useDocUnwarping": False,
+    "useChartRecognition": False,
+}
+
+# Shared session: keep-alive connections are reused across API calls and
+# image downloads, with gzip/deflate responses (requests' default Accept-Encoding).
+# Only GETs are retried; the parse POST is not replayed since it counts against quota.
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=8,
+    pool_maxsize=32,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504],
+                      allowed_methods=frozenset({"GET"}))
+))
+
+OUTPUT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "output_paddle"))
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
+# Number of files sent to the API at the same time in process_folder
+PADDLE_CONCURRENCY = int(os.getenv("PADDLE_CONCURRENCY", "4"))
+# Number of result images downloaded at the same time
+IMAGE_DOWNLOAD_WORKERS = 8
+
+# Regexes used by the HTML → Markdown cleanup, compiled once at import.
+# _RE_HTML covers every element clean_html_to_markdown rewrites, so the
+# document is scanned once instead of once per element type.
+_RE_HTML = re.compile(
+    r'(?P<table><table[^>]*>.*?</table>)'
+    r'|(?P<div><div[^>]*>)'
+    r'|(?P<div_end></div>)'
+    r'|(?P<span></?span[^>]*>)'
+    r'|(?P<br><br\s*/?>)'
+    r'|(?P<tag><[^>]+>)',
+    re.DOTALL | re.IGNORECASE
+)
+# Only tried on <div> tags that contain the literal "text-align"
+_RE_CENTER_DIV = re.compile(
+    r'<div[^>]*style=["\'][^"\']*text-align:\s*center[^"\']*["\'][^>]*>',
+    re.IGNORECASE
+)
+_RE_BR = re.compile(r'<br\s*/?>', re.IGNORECASE)
+_RE_ANYTAG = re.compile(r'<[^>]+>')
+# Runs of 4+ newlines (→ 3) or 3+ spaces (→ 2), collapsed in one pass
+_RE_WS_RUNS = re.compile(r'\n{4,}| {3,}')
+_RE_EMPTY_BOLD = re.compile(r'\*\*\s*\*\*')
+_RE_ROW = re.compile(r'<tr[^>]*>(.*?)</tr>', re.DOTALL | re.IGNORECASE)
+_RE_CELL = re.compile(r'<t[dh][^>]*>(.*?)</t[dh]>', re.DOTALL | re.IGNORECASE)
+
 
 # -----------------------------
 # HTML Table → Markdown Table Converter
 # -----------------------------
-class TableHTMLParser(HTMLParser):
-    """Parse HTML table and extract rows/cells"""
-    def __init__(self):
-        super().__init__()
-        self.rows = []
-        self.current_row = []
-        self.current_cell = ""
-        self.in_cell = False
-        self.is_header = False
-        
-    def handle_starttag(self, tag, attrs):
-        if tag == 'tr':
-            self.current_row = []
-        elif tag in ('td', 'th'):
-            self.in_cell = True
-            self.current_cell = ""
-            if tag == 'th':
-                self.is_header = True
-        elif tag == 'br' and self.in_cell:
-            self.current_cell += " "
-            
-    def handle_endtag(self, tag):
-        if tag == 'tr':
-            if self.current_row:
-                self.rows.append(self.current_row)
-        elif tag in ('td', 'th'):
-            self.in_cell = False
-            self.current_row.append(self.current_cell.strip())
-            
-    def handle_data(self, data):
-        if self.in_cell:
-            self.current_cell += data
+def _table_rows_regex(html_table):
+    """
+    Extract rows/cells with a regex scan. PaddleOCR only emits
+    <tr>/<td>/<th>/<br> inside tables: <br> becomes a space, other inline
+    tags are dropped.
+    """
+    rows = []
+    for row in _RE_ROW.findall(html_table):
+        cells = [
+            html.unescape(_RE_ANYTAG.sub('', _RE_BR.sub(' ', cell))).strip()
+            for cell in _RE_CELL.findall(row)
+        ]
+        if cells:
+            rows.append(cells)
+    return rows
+
+
+def _table_rows_lxml(html_table):
+    """Extract rows/cells with lxml's C parser (same output as the regex scan)"""
+    tree = lxml_html.fragment_fromstring(html_table, create_parent="div")
+    rows = []
+    for row in tree.iter("tr"):
+        cells = []
+        for cell in row.xpath("./td|./th"):
+            for br in cell.iter("br"):
+                br.tail = " " + (br.tail or "")
+            cells.append(cell.text_content().strip())
+        if cells:
+            rows.append(cells)
+    return rows
+
+
+def table_rows(html_table):
+    """Extract rows/cells from an HTML table as lists of cell text"""
+    if lxml_html is not None:
+        try:
+            return _table_rows_lxml(html_table)
+        except Exception:
+            # If lxml can't parse it, fall back to the regex scan
+            pass
+    return _table_rows_regex(html_table)
+
+
+def _markdown_row(cells):
+    """Format one table row, escaping pipe characters in cell content"""
+    return "| " + " | ".join(cell.replace('|', '\\|') for cell in cells) + " |"
 
 
 def html_table_to_markdown(html_table):
@@ -69,31 +159,54 @@ def html_table_to_markdown(html_table):
     Returns:
         Markdown formatted table with | separators
     """
-    parser = TableHTMLParser()
-    try:
-        parser.feed(html_table)
-    except Exception:
-        # If parsing fails, just strip HTML tags
-        return re.sub(r'<[^>]+>', ' ', html_table).strip()
+    rows = table_rows(html_table)
     
-    if not parser.rows:
+    if not rows:
         return ""
     
-    # Build markdown table
-    md_lines = []
+    header, *body = rows
+    separator = "|---" * len(header) + "|"
     
-    for i, row in enumerate(parser.rows):
-        # Escape pipe characters in cell content
-        cells = [cell.replace('|', '\\|') for cell in row]
-        line = "| " + " | ".join(cells) + " |"
-        md_lines.append(line)
-        
-        # Add separator after first row (header)
-        if i == 0:
-            separator = "|" + "|".join(["---" for _ in row]) + "|"
-            md_lines.append(separator)
+    return "\n".join([_markdown_row(header), separator, *map(_markdown_row, body)])
+
+
+def _convert_html(text):
+    """
+    Rewrite tables, divs, spans and <br> and drop all other tags in a single
+    scan. Open <div>s are tracked on a stack so a centered div gets its **
+    markers only once it is closed (and not again when nested in another
+    centered div).
+    """
+    parts = []
+    open_divs = []  # per open <div>: index of its placeholder in parts if centered, else None
+    pos = 0
     
-    return "\n".join(md_lines)
+    for match in _RE_HTML.finditer(text):
+        parts.append(text[pos:match.start()])
+        pos = match.end()
+        
+        kind = match.lastgroup
+        if kind == "table":
+            md_table = html_table_to_markdown(match.group())
+            parts.append("\n\n" + md_table + "\n\n" if md_table else "")
+        elif kind == "div":
+            # Cheap literal check first; the style regex backtracks heavily
+            tag = match.group()
+            centered = 'text-align' in tag.lower() and _RE_CENTER_DIV.match(tag)
+            open_divs.append(len(parts) if centered else None)
+            parts.append("")
+        elif kind == "div_end":
+            if open_divs:
+                opening = open_divs.pop()
+                if opening is not None and all(i is None for i in open_divs):
+                    parts[opening] = "**"
+                    parts.append("**")
+        elif kind == "br":
+            parts.append("\n")
+        # <span> and any other tags are dropped, keeping their content
+    
+    parts.append(text[pos:])
+    return "".join(parts)
 
 
 def clean_html_to_markdown(text):
@@ -109,59 +222,26 @@ def clean_html_to_markdown(text):
     Returns:
         Cleaned markdown text
     """
+    # Each step is skipped when a plain substring check shows it has nothing to do
+    # (most OCR pages contain no HTML at all)
     result = text
     
-    # 1. Convert HTML tables to Markdown tables
-    table_pattern = re.compile(r'<table[^>]*>.*?</table>', re.DOTALL | re.IGNORECASE)
-    
-    def replace_table(match):
-        html_table = match.group(0)
-        md_table = html_table_to_markdown(html_table)
-        return "\n\n" + md_table + "\n\n" if md_table else ""
-    
-    result = table_pattern.sub(replace_table, result)
-    
-    # 2. Convert <div style="text-align: center;">content</div> → **content**
-    div_center_pattern = re.compile(
-        r'<div[^>]*style=["\'][^"\']*text-align:\s*center[^"\']*["\'][^>]*>(.*?)</div>',
-        re.DOTALL | re.IGNORECASE
-    )
-    result = div_center_pattern.sub(r'**\1**', result)
-    
-    # 3. Remove remaining div tags but keep content
-    result = re.sub(r'<div[^>]*>(.*?)</div>', r'\1', result, flags=re.DOTALL | re.IGNORECASE)
-    
-    # 4. Remove span tags but keep content
-    result = re.sub(r'<span[^>]*>(.*?)</span>', r'\1', result, flags=re.DOTALL | re.IGNORECASE)
+    # 1-6. Tables → Markdown, centered divs → **bold**, unwrap div/span,
+    # <br> → newline, drop any remaining tags
+    if '<' in result:
+        result = _convert_html(result)
     
-    # 5. Convert <br> and <br/> to newlines
-    result = re.sub(r'<br\s*/?>', '\n', result, flags=re.IGNORECASE)
-    
-    # 6. Remove any remaining HTML tags
-    result = re.sub(r'<[^>]+>', '', result)
-    
-    # 7. Clean up excessive whitespace
-    result = re.sub(r'\n{4,}', '\n\n\n', result)  # Max 3 newlines
-    result = re.sub(r' {3,}', '  ', result)  # Max 2 spaces
+    # 7. Clean up excessive whitespace: max 3 newlines, max 2 spaces
+    if '\n\n\n\n' in result or '   ' in result:
+        result = _RE_WS_RUNS.sub(lambda m: '\n\n\n' if m.group()[0] == '\n' else '  ', result)
     
     # 8. Remove empty bold markers
-    result = re.sub(r'\*\*\s*\*\*', '', result)
+    if '**' in result:
+        result = _RE_EMPTY_BOLD.sub('', result)
     
     return result.strip()
 
 
-def encode_file_to_base64(file_path):
-    """Encode file to base64 string"""
-    with open(file_path, "rb") as f:
-        return base64.b64encode(f.read()).decode("utf-8")
-
-
-def get_file_url(file_path):
-    """For URL-based upload, encode to data URI or return existing URL"""
-    # For local files, we use base64 encoding instead
-    return None
-
-
 def parse_pdf_sync(file_path, use_chart_recognition=False, use_doc_unwarping=False):
     """
     Sync parse a PDF file using PaddleOCR API
@@ -174,19 +254,18 @@ def parse_pdf_sync(file_path, use_chart_recognition=False, use_doc_unwarping=Fal
     Returns:
         API result with layout parsing data
     """
-    headers = {
-        "Authorization": f"token {PADDLE_ACCESS_TOKEN}",
-        "Content-Type": "application/json",
-    }
-    
-    # Encode file to base64
+    # Encode file to base64 straight from a memory map, so the raw bytes
+    # are never copied into Python memory
     with open(file_path, 'rb') as f:
-        file_bytes = f.read()
-    file_base64 = base64.b64encode(file_bytes).decode("ascii")
+        if os.fstat(f.fileno()).st_size == 0:
+            file_base64 = ""
+        else:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                file_base64 = base64.b64encode(mm).decode("ascii")
     file_name = os.path.basename(file_path)
     
     # Determine file type: 0=PDF, 1=Image
-    if file_path.lower().endswith('.pdf'):
+    if os.path.splitext(file_path)[1].lower() == '.pdf':
         file_type = 0
     else:
         file_type = 1
@@ -195,14 +274,15 @@ def parse_pdf_sync(file_path, use_chart_recognition=False, use_doc_unwarping=Fal
     
     # Correct payload: use "file" + "fileType" (not "images")
     payload = {
+        **PAYLOAD_DEFAULTS,
         "file": file_base64,
         "fileType": file_type,
-        "useDocOrientationClassify": False,
         "useDocUnwarping": use_doc_unwarping,
         "useChartRecognition": use_chart_recognition,
     }
     
-    response = requests.post(URL_API_PADDLE, json=payload, headers=headers, timeout=600)
+    # Body is serialized ourselves (headers already carry the JSON Content-Type)
+    response = _SESSION.post(URL_API_PADDLE, data=_json_dumps(payload), headers=HEADERS, timeout=600)
     
     if response.status_code == 429:
         raise Exception("Rate limit exceeded - daily parsing limit reached")
@@ -211,7 +291,7 @@ def parse_pdf_sync(file_path, use_chart_recognition=False, use_doc_unwarping=Fal
         print(f"Error response: {response.text}")
         raise Exception(f"API error: {response.status_code}")
     
-    result = response.json()
+    result = _json_loads(response.content)
     
     if "result" not in result:
         raise Exception(f"Unexpected response format: {result}")
@@ -219,6 +299,18 @@ def parse_pdf_sync(file_path, use_chart_recognition=False, use_doc_unwarping=Fal
     return result["result"]
 
 
+def save_image(full_img_path, img_url):
+    """Download one result image to full_img_path (directory must exist), streaming it to disk"""
+    try:
+        with _SESSION.get(img_url, timeout=30, stream=True) as res:
+            res.raise_for_status()
+            with open(full_img_path, "wb") as img_file:
+                for block in res.iter_content(chunk_size=64 * 1024):
+                    img_file.write(block)
+    except Exception as e:
+        print(f"⚠️ Failed to save image {os.path.relpath(full_img_path, OUTPUT_DIR)}: {e}")
+
+
 def extract_markdown_from_result(result, save_images=True, clean_html=True):
     """
     Extract markdown text and images from PaddleOCR result
@@ -232,33 +324,40 @@ def extract_markdown_from_result(result, save_images=True, clean_html=True):
         Combined markdown text
     """
     markdown_parts = []
+    image_tasks = []
     
     layout_results = result.get("layoutParsingResults", [])
     
     for i, res in enumerate(layout_results):
         md_text = res.get("markdown", {}).get("text", "")
+        
+        # Clean HTML tables → Markdown tables, page by page (small strings
+        # scan faster than one big joined document)
+        if clean_html:
+            md_text = clean_html_to_markdown(md_text)
         markdown_parts.append(md_text)
         
         # Optionally save images
         if save_images:
-            images = res.get("markdown", {}).get("images", {})
-            for img_path, img_url in images.items():
-                try:
-                    full_img_path = os.path.join(OUTPUT_DIR, img_path)
-                    os.makedirs(os.path.dirname(full_img_path), exist_ok=True)
-                    img_bytes = requests.get(img_url, timeout=30).content
-                    with open(full_img_path, "wb") as img_file:
-                        img_file.write(img_bytes)
-                except Exception as e:
-                    print(f"⚠️ Failed to save image {img_path}: {e}")
-    
-    combined = "\n\n---\n\n".join(markdown_parts)
-    
-    # Clean HTML tables → Markdown tables
-    if clean_html:
-        combined = clean_html_to_markdown(combined)
-    
-    return combined
+            for img_path, img_url in res.get("markdown", {}).get("images", {}).items():
+                image_tasks.append((os.path.join(OUTPUT_DIR, img_path), img_url))
+    
+    # Images are independent downloads, so fetch them concurrently.
+    # Directories are created once up front, not once per image; images
+    # whose directory can't be created are reported and skipped.
+    if image_tasks:
+        failed_dirs = set()
+        for img_dir in {os.path.dirname(full_img_path) for full_img_path, _ in image_tasks}:
+            try:
+                os.makedirs(img_dir, exist_ok=True)
+            except OSError as e:
+                print(f"⚠️ Failed to create image directory {os.path.relpath(img_dir, OUTPUT_DIR)}: {e}")
+                failed_dirs.add(img_dir)
+        image_tasks = [task for task in image_tasks if os.path.dirname(task[0]) not in failed_dirs]
+        with ThreadPoolExecutor(max_workers=IMAGE_DOWNLOAD_WORKERS) as executor:
+            list(executor.map(lambda task: save_image(*task), image_tasks))
+    
+    return "\n\n---\n\n".join(markdown_parts)
 
 
 def process_pdf(file_path, save_images=True):
@@ -307,16 +406,25 @@ def process_folder(folder_path, file_pattern="*.pdf"):
     
     print(f"📂 Found {len(pdf_files)} files to process")
     
-    all_markdown = []
-    
-    for i, pdf_file in enumerate(pdf_files, 1):
-        print(f"\n[{i}/{len(pdf_files)}] Processing {os.path.basename(pdf_file)}...")
-        try:
-            markdown, _ = process_pdf(pdf_file, save_images=False)
-            all_markdown.append(markdown)
-        except Exception as e:
-            print(f"⚠️ Error processing {pdf_file}: {e}")
-            continue
+    # Files are independent remote calls, so send several at once;
+    # results are stored by index to keep the original file order
+    results = [None] * len(pdf_files)
+    
+    with ThreadPoolExecutor(max_workers=PADDLE_CONCURRENCY) as executor:
+        futures = {
+            executor.submit(process_pdf, pdf_file, False): i
+            for i, pdf_file in enumerate(pdf_files)
+        }
+        for done, future in enumerate(as_completed(futures), 1):
+            i = futures[future]
+            pdf_file = pdf_files[i]
+            try:
+                results[i], _ = future.result()
+                print(f"\n[{done}/{len(pdf_files)}] Processed {os.path.basename(pdf_file)}")
+            except Exception as e:
+                print(f"⚠️ Error processing {pdf_file}: {e}")
+    
+    all_markdown = [markdown for markdown in results if markdown is not None]
     
     combined = "\n\n---\n\n".join(all_markdown)
     print(f"\n✅ Combined {len(all_markdown)} files, total {len(combined)} characters")
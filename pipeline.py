@@ -12,11 +12,8 @@ import sys
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from elastic.elastic_rag import (
-    ingest_mineru, ingest_paddle, 
-    ask_mineru, ask_paddle, ask_all,
-    ES_INDEX_MINERU, ES_INDEX_PADDLE
-)
+# OCR and Elasticsearch modules are imported inside the functions that use
+# them, so --help / usage output doesn't pay for loading their clients
 
 
 def run_mineru_pipeline(pdf_path):
@@ -25,6 +22,7 @@ def run_mineru_pipeline(pdf_path):
     PDF → MinerU OCR → Markdown → Elasticsearch (mineru index)
     """
     from ocr.mineru_ocr import process_pdf
+    from elastic.elastic_rag import ingest_mineru, ES_INDEX_MINERU
     
     file_name = os.path.basename(pdf_path)
     
@@ -67,6 +65,7 @@ def run_paddle_pipeline(path, is_folder=False):
         is_folder: True if path is a folder with split PDF pages
     """
     from ocr.paddle_ocr import process_pdf, process_folder
+    from elastic.elastic_rag import ingest_paddle, ES_INDEX_PADDLE
     
     print("=" * 50)
     print("🚀 PADDLEOCR RAG PIPELINE")
@@ -113,6 +112,8 @@ def run_paddle_pipeline(path, is_folder=False):
 
 def interactive_qa(index="all"):
     """Interactive Q&A mode"""
+    from elastic.elastic_rag import ask_mineru, ask_paddle, ask_all
+    
     print(f"\n🤖 Interactive Q&A Mode - Index: {index}")
     print("Type 'quit' to exit, 'switch' to change index")
     print("-" * 40)